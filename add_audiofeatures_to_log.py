@@ -1,11 +1,25 @@
-from dataclasses import dataclass, asdict
-import datetime
+from dataclasses import dataclass, fields
 import time
 from pathlib import Path
-import json
-from decouple import config
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
+from spotipy.exceptions import SpotifyException
+from spotify_common import (
+    TRACK_LOGFILE,
+    AF_FIELDS,
+    convert_legacy_track_logfile,
+    create_spotify,
+    format_play_time,
+    open_af_cache,
+    select_audio_features,
+    insert_audio_features,
+)
 
 """
 Audio features explanation
@@ -46,44 +60,52 @@ time_signatur: A measure from 0.0 to 1.0 describing the musical positiveness con
   with high valence sound more positive (e.g. happy, cheerful, euphoric), while tracks with low valence
   sound more negative (e.g. sad, depressed, angry).
 """
-TRACK_LOGFILE = Path("logs/track_log.json")
-MODIFIED_TRACK_LOGFILE = Path("logs/track_log_modified.json")
+MODIFIED_TRACK_LOGFILE = Path("logs/track_log_modified.jsonl")
 BATCH_LENGTH = 100
+CONCURRENCY = 8
 DELAY = 30
-SCOPE = "user-read-currently-playing"
-SPOTIFY_CLIENT_ID = config("SPOTIFY_CLIENT_ID")
-SPOTIFY_CLIENT_SECRET = config("SPOTIFY_CLIENT_SECRET")
-SPOTIFY_REDIRECT_URI = config("SPOTIFY_REDIRECT_URI")
-
-spotify_authorization = SpotifyOAuth(
-    SPOTIFY_CLIENT_ID,
-    SPOTIFY_CLIENT_SECRET,
-    SPOTIFY_REDIRECT_URI,
-    scope=SCOPE,
-    # show_dialog=True,
-    # open_browser=False,
-)
-spotify = spotipy.Spotify(auth_manager=spotify_authorization)
-
-
-af_empty = {
-    "duration_ms": 0,
-    "acousticness": None,
-    "danceability": None,
-    "energy": None,
-    "instrumentalness": None,
-    "key": None,
-    "liveness": None,
-    "loudness": None,
-    "mode": None,
-    "speechiness": None,
-    "tempo": None,
-    "time_signature": None,
-    "valence": None,
-}
-
-
-@dataclass
+MAX_RETRIES = 5
+PROGRESS_INTERVAL = 1.0
+
+
+def create_requests_session():
+    # a single session keeping a connection alive for each concurrent batch,
+    # only server errors are retried here, urllib3 would also retry a 429 with
+    # a Retry-After header so that is switched off and rate limiting is left
+    # to get_audio_features
+    retry = Retry(
+        total=3,
+        read=False,
+        status=3,
+        backoff_factor=0.3,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=False,
+    )
+    adapter = HTTPAdapter(pool_maxsize=CONCURRENCY, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+spotify = create_spotify(requests_session=create_requests_session())
+
+
+# audio features by track id, shared by the batches processed concurrently
+af_cache = open_af_cache()
+af_cache_lock = threading.Lock()
+
+# futures of the audio features fetched in this run by track id, kept until the
+# end of the run so a track played in several batches in flight is only fetched
+# by the first of these batches
+af_fetches = {}
+af_fetches_lock = threading.Lock()
+
+
+af_empty = {"duration_ms": 0, **dict.fromkeys(AF_FIELDS)}
+
+
+@dataclass(slots=True)
 class TrackRecord:
     played_at: str
     name: str
@@ -104,17 +126,37 @@ class TrackRecord:
     valence: float
 
     def as_dict(self):
-        return asdict(self)
+        # the record is flat, so there is no need for the deep copy of asdict
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+TRACK_FIELDS = tuple(field.name for field in fields(TrackRecord))
+
+
+def read_spotify_account():
+    # the first line of the track log holds the spotify account
+    with open(TRACK_LOGFILE, "rb") as log_file:
+        return orjson.loads(log_file.readline())["spotify_account"]
 
 
-def read_track_logfile():
-    with open(TRACK_LOGFILE, "r") as json_file:
-        return json.load(json_file)
+def iter_track_logfile():
+    # stream the tracks one line at a time so the log is never loaded as a whole
+    with open(TRACK_LOGFILE, "rb") as log_file:
+        yield from map(orjson.loads, islice(log_file, 1, None))
 
 
-def update_track_logfile(tracks_log):
-    with open(MODIFIED_TRACK_LOGFILE, "w") as json_file:
-        json.dump(tracks_log, json_file)
+def write_track_record(log_file, track_record: dict):
+    log_file.write(orjson.dumps(track_record, option=orjson.OPT_APPEND_NEWLINE))
+
+
+def read_af_cache(tracks: list) -> dict:
+    with af_cache_lock:
+        return select_audio_features(af_cache, tracks)
+
+
+def update_af_cache(tracks_af: dict):
+    with af_cache_lock:
+        insert_audio_features(af_cache, tracks_af)
 
 
 def print_track(track):
@@ -122,74 +164,146 @@ def print_track(track):
 
 
 def get_audio_features(tracks: list) -> list:
-    try:
-        return spotify.audio_features(tracks=tracks)
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return spotify.audio_features(tracks=tracks)
+
+        except SpotifyException as e:
+            # spotipy also reports server errors that ran out of retries as a
+            # 429, but without the headers of a response
+            rate_limited = e.http_status == 429 and e.headers
+            if not rate_limited or attempt == MAX_RETRIES:
+                print(f"get_track_audio_features, exception {e}, exit the program ...")
+                exit()
 
-    except Exception as e:
-        print(f"get_track_audio_features, exception {e}, exit the program ...")
-        exit()
+            # rate limited, wait at least as long as spotify asks for and back off
+            # exponentially up to DELAY seconds on repeated failures
+            retry_after = int(e.headers.get("Retry-After", 0))
+            time.sleep(max(retry_after, min(2**attempt, DELAY)))
+
+        except Exception as e:
+            print(f"get_track_audio_features, exception {e}, exit the program ...")
+            exit()
+
+
+def fetch_audio_features(tracks: list) -> dict:
+    # fetch the tracks no other batch has fetched or is fetching, then wait for
+    # the audio features of the tracks fetched by other batches
+    own_fetches = {}
+    other_fetches = {}
+    with af_fetches_lock:
+        for track in tracks:
+            if track in af_fetches:
+                other_fetches[track] = af_fetches[track]
+            else:
+                af_fetches[track] = own_fetches[track] = Future()
+
+    if own_fetches:
+        try:
+            tracks_af = dict(zip(own_fetches, get_audio_features(list(own_fetches))))
+            update_af_cache(tracks_af)
+
+        except BaseException as e:
+            # get_audio_features exits the program on an error, pass that on
+            # to the batches waiting for these tracks instead of leaving them
+            # waiting forever
+            for future in own_fetches.values():
+                future.set_exception(e)
+            raise
+
+        for track, future in own_fetches.items():
+            future.set_result(tracks_af[track])
+
+    fetches = {**own_fetches, **other_fetches}
+    return {track: future.result() for track, future in fetches.items()}
+
+
+def is_complete(track: dict) -> bool:
+    return bool(track.get("play_time")) and track.get("acousticness") is not None
+
+
+def process_batch(tracks_batch: list) -> list:
+    # audio features are only needed for tracks without play_time or acousticness
+    tracks_id = list(
+        dict.fromkeys(track["id"] for track in tracks_batch if not is_complete(track))
+    )
+    if not tracks_id:
+        return tracks_batch
+
+    # only tracks not yet in the audio features cache are fetched from spotify,
+    # each track once even if it is played more than once in the batch or in
+    # other batches
+    tracks_af = read_af_cache(tracks_id)
+    unknown_tracks_id = [track for track in tracks_id if track not in tracks_af]
+    if unknown_tracks_id:
+        tracks_af.update(fetch_audio_features(unknown_tracks_id))
+
+    track_records = []
+    for track in tracks_batch:
+        # complete tracks are kept as they are in the track log
+        if is_complete(track):
+            track_records.append(track)
+            continue
+
+        af = tracks_af[track["id"]]
+        if af is None:
+            af = af_empty
+        play_time = track.get("play_time")
+        if not play_time:
+            play_time = format_play_time(af["duration_ms"] * 0.001)
+
+        # merge the track with its audio features, the audio features take
+        # precedence over any already in the track log
+        track_af = {**track, **{k: af[k] for k in AF_FIELDS}, "play_time": play_time}
+        modified_track_record = TrackRecord(**{k: track_af[k] for k in TRACK_FIELDS})
+        track_records.append(modified_track_record.as_dict())
+
+    return track_records
+
+
+def process_batches(batches):
+    # process up to CONCURRENCY batches at the same time, the results are
+    # yielded in the order of the batches
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        pending = deque()
+        for tracks_batch in batches:
+            pending.append(executor.submit(process_batch, tracks_batch))
+            if len(pending) == CONCURRENCY:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
 
 
 def main():
-    tracks_log = read_track_logfile()
-    tracks = tracks_log["tracks"]
-    modified_log = {}
-    modified_log["spotify_account"] = tracks_log["spotify_account"]
-    modified_log["tracks"] = []
-    batch = 1
-    nr_tracks = len(tracks)
+    convert_legacy_track_logfile()
+    # authorize or refresh the token once before the batches are processed
+    # concurrently, otherwise every worker does so at the same time
+    spotify.auth_manager.get_access_token(as_dict=False)
+    tracks = iter_track_logfile()
+    batches = iter(lambda: list(islice(tracks, BATCH_LENGTH)), [])
+    batch = 0
     start = 0
-    end = min(start + BATCH_LENGTH, nr_tracks)
-    # work in batches of BATCH_LENGTH
-    while start < end:
-
-        all_play_time = all(t.get("play_time") for t in tracks[start:end])
-        all_acousticness = all(t.get("acousticness") for t in tracks[start:end])
-        if not all_play_time or not all_acousticness:
-            # get audio features if any in this batch does not contain play_time or acousticness
-            tracks_id = [track["id"] for track in tracks[start:end]]
-            tracks_af = get_audio_features(tracks_id)
-            for index, af in enumerate(tracks_af, start):
-                if af is None:
-                    af = af_empty
-                play_time = tracks[index].get("play_time")
-                if not play_time:
-                    play_time = f"{datetime.timedelta(seconds=round(af["duration_ms"] * 0.001, 0))}"
-
-                modified_track_record = TrackRecord(
-                    id=tracks[index]["id"],
-                    played_at=tracks[index]["played_at"],
-                    artist=tracks[index]["artist"],
-                    name=tracks[index]["name"],
-                    play_time=play_time,
-                    acousticness=af["acousticness"],
-                    danceability=af["danceability"],
-                    energy=af["energy"],
-                    instrumentalness=af["instrumentalness"],
-                    key=af["key"],
-                    liveness=af["liveness"],
-                    loudness=af["loudness"],
-                    mode=af["mode"],
-                    speechiness=af["speechiness"],
-                    tempo=af["tempo"],
-                    time_signature=af["time_signature"],
-                    valence=af["valence"],
-                )
-                modified_log["tracks"].append(modified_track_record.as_dict())
-
-            time.sleep(2)
-
-        else:
-            for index in range(start, end):
-                modified_log["tracks"].append(tracks[index])
-
-        print(f"Processed batch: {batch:3} ({start:6}: {end:6})", end="\r")
-        update_track_logfile(modified_log)
-        start += BATCH_LENGTH
-        end = min(start + BATCH_LENGTH, nr_tracks)
-        batch += 1
-
-    print(f"\ncompleted {batch - 1} batches, {nr_tracks} tracks")
+    last_progress = 0.0
+    # the modified log is written as json lines, the first line holds the
+    # spotify account followed by a line for each track
+    with open(MODIFIED_TRACK_LOGFILE, "wb") as modified_log:
+        write_track_record(modified_log, {"spotify_account": read_spotify_account()})
+        # work in batches of BATCH_LENGTH
+        for batch, track_records in enumerate(process_batches(batches), 1):
+            end = start + len(track_records)
+            for track_record in track_records:
+                write_track_record(modified_log, track_record)
+
+            modified_log.flush()
+            # limit the progress updates to one per PROGRESS_INTERVAL seconds
+            if (now := time.monotonic()) - last_progress > PROGRESS_INTERVAL:
+                print(f"Processed batch: {batch:3} ({start:6}: {end:6})", end="\r")
+                last_progress = now
+
+            start = end
+
+    print(f"\ncompleted {batch} batches, {start} tracks")
 
 
 if __name__ == "__main__":
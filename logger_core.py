@@ -0,0 +1,95 @@
+from abc import ABC, abstractmethod
+import time
+import datetime
+import orjson
+from spotify_common import TRACK_LOGFILE, convert_legacy_track_logfile, create_spotify
+
+TIME_DELAY = 5
+MAX_TIME_DELAY = 30
+MINIMUM_PLAY_TIME = 20
+
+spotify = create_spotify()
+
+
+def create_track_logfile():
+    # the track log is written as json lines, the first line holds the spotify
+    # account followed by a line for each track
+    convert_legacy_track_logfile()
+    if not TRACK_LOGFILE.exists():
+        append_track_record({"spotify_account": spotify.current_user()["id"]})
+
+
+def append_track_record(track_record: dict):
+    with open(TRACK_LOGFILE, "ab") as log_file:
+        log_file.write(orjson.dumps(track_record, option=orjson.OPT_APPEND_NEWLINE))
+
+
+def print_track(track):
+    print(f"{track = }")
+
+
+def get_track_update():
+    track = None
+    try:
+        track = spotify.current_user_playing_track()
+
+    except Exception as e:
+        print(f"Exception occured at {time.ctime()}: {e}")
+        time.sleep(60)
+
+    return track
+
+
+class LoggerBase(ABC):
+    # polls the currently playing track and logs every track played for more
+    # than MINIMUM_PLAY_TIME, a logger creates its track record for a new track
+    # in new_track_record and completes it in finish_track_record before the
+    # record is logged in log_track_record
+    @abstractmethod
+    def new_track_record(self, item: dict, played_at: str):
+        pass
+
+    @abstractmethod
+    def finish_track_record(self, track_record, play_time: float):
+        pass
+
+    def log_track_record(self, track_record, play_time: float):
+        self.finish_track_record(track_record, play_time)
+        print_track(track_record)
+        append_track_record(track_record.as_dict())
+
+    def run(self):
+        create_track_logfile()
+        track_id = None
+        time_delay = TIME_DELAY
+
+        while True:
+            track = get_track_update()
+            new_track = track and track["item"] and track_id != track["item"]["id"]
+
+            # if there is a new_track or no track is playing then log the previous
+            # track only if played for more than MINIMUM_PLAY_TIME
+            if (new_track and track_id) or (track is None and track_id):
+                play_time = time.monotonic() - track_started
+                if play_time > MINIMUM_PLAY_TIME:
+                    self.log_track_record(track_record, play_time)
+
+            # update track attributes
+            if new_track:
+                track_id = track["item"]["id"]
+                # the play time is measured on the monotonic clock, the wall clock
+                # is only needed once for played_at
+                track_started = time.monotonic()
+                played_at = datetime.datetime.now().strftime("%Y-%B-%d %H:%M:%S")
+                track_record = self.new_track_record(track["item"], played_at)
+
+            # while nothing is playing double the delay between polls up to
+            # MAX_TIME_DELAY, poll every TIME_DELAY again once a track plays
+            if track is None:
+                track_id = None
+                time_delay = min(2 * time_delay, MAX_TIME_DELAY)
+
+            else:
+                time_delay = TIME_DELAY
+
+            time.sleep(time_delay)
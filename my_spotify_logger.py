@@ -1,11 +1,14 @@
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 import time
-import datetime
-from pathlib import Path
-import json
-from decouple import config
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+from concurrent.futures import ThreadPoolExecutor
+from logger_core import LoggerBase, spotify
+from spotify_common import (
+    AF_FIELDS,
+    format_play_time,
+    open_af_cache,
+    select_audio_features,
+    insert_audio_features,
+)
 
 """
 Audio features explanation
@@ -46,26 +49,11 @@ time_signatur: A measure from 0.0 to 1.0 describing the musical positiveness con
   with high valence sound more positive (e.g. happy, cheerful, euphoric), while tracks with low valence
   sound more negative (e.g. sad, depressed, angry).
 """
-TRACK_LOGFILE = Path("logs/track_log.json")
-TIME_DELAY = 5
-MINIMUM_PLAY_TIME = 20
-SCOPE = "user-read-currently-playing"
-SPOTIFY_CLIENT_ID = config("SPOTIFY_CLIENT_ID")
-SPOTIFY_CLIENT_SECRET = config("SPOTIFY_CLIENT_SECRET")
-SPOTIFY_REDIRECT_URI = config("SPOTIFY_REDIRECT_URI")
-
-spotify_authorization = SpotifyOAuth(
-    SPOTIFY_CLIENT_ID,
-    SPOTIFY_CLIENT_SECRET,
-    SPOTIFY_REDIRECT_URI,
-    scope=SCOPE,
-    # show_dialog=True,
-    # open_browser=False,
-)
-spotify = spotipy.Spotify(auth_manager=spotify_authorization)
+# audio features by track id, only used by the thread fetching the audio features
+af_cache = open_af_cache()
 
 
-@dataclass
+@dataclass(slots=True)
 class TrackRecord:
     played_at: str
     name: str
@@ -86,98 +74,58 @@ class TrackRecord:
     valence: float
 
     def as_dict(self):
-        return asdict(self)
-
-
-def read_track_logfile():
-    with open(TRACK_LOGFILE, "r") as json_file:
-        return json.load(json_file)
-
+        # the record is flat, so there is no need for the deep copy of asdict
+        return {k: getattr(self, k) for k in self.__slots__}
 
-def update_track_logfile(tracks_log):
-    with open(TRACK_LOGFILE, "w") as json_file:
-        json.dump(tracks_log, json_file)
-
-
-def print_track(track):
-    print(f"{track = }")
 
+def get_track_audio_features(track: str) -> dict:
+    if af := select_audio_features(af_cache, [track]).get(track):
+        return af
 
-def get_track_update():
-    track = None
     try:
-        track = spotify.current_user_playing_track()
+        af = spotify.audio_features(tracks=[track])[0]
+        insert_audio_features(af_cache, {track: af})
+        return af
 
     except Exception as e:
         print(f"Exception occured at {time.ctime()}: {e}")
         time.sleep(60)
+        return None
 
-    return track
 
+class AudioFeaturesLogger(LoggerBase):
+    def __init__(self):
+        # fetching the audio features and logging the track is done by a single
+        # worker in the order the tasks are submitted, so the audio features of
+        # a track are in the record before it is logged and polling continues
+        # while waiting for spotify
+        self.executor = ThreadPoolExecutor(max_workers=1)
 
-def get_track_audio_features(track: str) -> dict:
-    try:
-        return spotify.audio_features(tracks=[track])[0]
+    def new_track_record(self, item: dict, played_at: str):
+        track_record = TrackRecord(*[None] * 17)
+        track_record.id = item["id"]
+        track_record.played_at = played_at
+        track_record.artist = item["artists"][0]["name"]
+        track_record.name = item["name"]
+        track_record.play_time = ""
+        self.executor.submit(self.add_audio_features, track_record)
+        return track_record
 
-    except Exception as e:
-        print(f"Exception occured at {time.ctime()}: {e}")
-        time.sleep(60)
-        return None
+    def add_audio_features(self, track_record):
+        af = get_track_audio_features(track_record.id)
+        if af is not None:
+            for k in AF_FIELDS:
+                setattr(track_record, k, af[k])
+
+    def finish_track_record(self, track_record, play_time: float):
+        track_record.play_time = format_play_time(play_time)
+
+    def log_track_record(self, track_record, play_time: float):
+        self.executor.submit(super().log_track_record, track_record, play_time)
 
 
 def main():
-    tracks_log = read_track_logfile()
-    track_id = None
-
-    while True:
-        track = get_track_update()
-        new_track = track and track["item"] and track_id != track["item"]["id"]
-
-        # if there is a new_track or no track is playing then log the previous
-        # track only if played for more than MINIMUM_PLAY_TIME
-        if (new_track and track_id) or (track is None and track_id):
-            play_time = (datetime.datetime.now() - track_played_at).total_seconds()
-            if play_time > MINIMUM_PLAY_TIME:
-                track_record.play_time = (
-                    f"{datetime.timedelta(seconds=round(play_time, 0))}"
-                )
-                print_track(track_record)
-                tracks_log["tracks"].append(track_record.as_dict())
-                update_track_logfile(tracks_log)
-
-        # update track attributes
-        if new_track:
-            track_record = TrackRecord(*[None] * 17)
-            track_id = track["item"]["id"]
-            track_played_at = datetime.datetime.now()
-            track_record.id = track_id
-            track_record.played_at = track_played_at.strftime("%Y-%B-%d %H:%M:%S")
-            track_record.artist = track["item"]["artists"][0]["name"]
-            track_record.name = track["item"]["name"]
-            track_record.play_time = ""
-
-            af = get_track_audio_features(track_id)
-            if af is None:
-                continue
-
-            else:
-                track_record.acousticness = af["acousticness"]
-                track_record.danceability = af["danceability"]
-                track_record.energy = af["energy"]
-                track_record.instrumentalness = af["instrumentalness"]
-                track_record.key = af["key"]
-                track_record.liveness = af["liveness"]
-                track_record.loudness = af["loudness"]
-                track_record.mode = af["mode"]
-                track_record.speechiness = af["speechiness"]
-                track_record.tempo = af["tempo"]
-                track_record.time_signature = af["time_signature"]
-                track_record.valence = af["valence"]
-
-        if track is None:
-            track_id = None
-
-        time.sleep(TIME_DELAY)
+    AudioFeaturesLogger().run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+# shared by the loggers and add_audiofeatures_to_log, this module only defines
+# helpers and does not connect to anything when it is imported
+from pathlib import Path
+import sqlite3
+import threading
+import orjson
+from decouple import config
+import spotipy
+from spotipy.oauth2 import SpotifyOAuth
+from spotipy.cache_handler import CacheFileHandler
+
+TRACK_LOGFILE = Path("logs/track_log.jsonl")
+LEGACY_TRACK_LOGFILE = Path("logs/track_log.json")
+SPOTIFY_CACHEFILE = Path(".cache")
+AF_CACHEFILE = Path("logs/af_cache.db")
+AF_FIELDS = (
+    "acousticness",
+    "danceability",
+    "energy",
+    "instrumentalness",
+    "key",
+    "liveness",
+    "loudness",
+    "mode",
+    "speechiness",
+    "tempo",
+    "time_signature",
+    "valence",
+)
+SCOPE = "user-read-currently-playing"
+
+
+class MemoryCacheFileHandler(CacheFileHandler):
+    # keep the token in memory instead of reading the cache file for every
+    # request, a refreshed token is still saved to the file for the next run
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_info = None
+
+    def get_cached_token(self):
+        if self.token_info is None:
+            self.token_info = super().get_cached_token()
+        return self.token_info
+
+    def save_token_to_cache(self, token_info):
+        self.token_info = token_info
+        super().save_token_to_cache(token_info)
+
+
+class LockedSpotifyOAuth(SpotifyOAuth):
+    # the client is shared by threads, only one thread at a time validates the
+    # token so an expired token is refreshed once and the other threads reuse
+    # the refreshed token kept in memory by MemoryCacheFileHandler
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_lock = threading.Lock()
+
+    def get_access_token(self, *args, **kwargs):
+        with self.token_lock:
+            return super().get_access_token(*args, **kwargs)
+
+
+def create_spotify(requests_session=True):
+    # the credentials are read from the environment or .env when the client is
+    # created, not when this module is imported
+    spotify_authorization = LockedSpotifyOAuth(
+        config("SPOTIFY_CLIENT_ID"),
+        config("SPOTIFY_CLIENT_SECRET"),
+        config("SPOTIFY_REDIRECT_URI"),
+        scope=SCOPE,
+        cache_handler=MemoryCacheFileHandler(cache_path=SPOTIFY_CACHEFILE),
+        # show_dialog=True,
+        # open_browser=False,
+    )
+    return spotipy.Spotify(
+        auth_manager=spotify_authorization, requests_session=requests_session
+    )
+
+
+def convert_legacy_track_logfile():
+    # the track log used to be a single json document holding the spotify account
+    # and a list of all tracks, convert it once to the json lines track log with
+    # the spotify account on the first line followed by a line for each track,
+    # the legacy file itself is left as it is
+    if TRACK_LOGFILE.exists() or not LEGACY_TRACK_LOGFILE.exists():
+        return
+
+    with open(LEGACY_TRACK_LOGFILE, "rb") as legacy_file:
+        tracks_log = orjson.loads(legacy_file.read())
+
+    # write to a temporary file first so an interrupted conversion does not
+    # leave a partial track log behind
+    converted_logfile = TRACK_LOGFILE.with_suffix(".tmp")
+    with open(converted_logfile, "wb") as log_file:
+        header = {"spotify_account": tracks_log["spotify_account"]}
+        for track_record in [header, *tracks_log["tracks"]]:
+            log_file.write(orjson.dumps(track_record, option=orjson.OPT_APPEND_NEWLINE))
+
+    converted_logfile.replace(TRACK_LOGFILE)
+    print(f"converted {LEGACY_TRACK_LOGFILE} to {TRACK_LOGFILE}")
+
+
+def format_play_time(seconds: float) -> str:
+    # same format as str(datetime.timedelta) without creating a timedelta
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+
+def open_af_cache():
+    # audio features by track id, the connection may be used from another
+    # thread than the one opening it
+    af_cache = sqlite3.connect(AF_CACHEFILE, check_same_thread=False)
+    af_cache.execute("create table if not exists af (id text primary key, json text)")
+    return af_cache
+
+
+def select_audio_features(af_cache, tracks: list) -> dict:
+    query = f"select id, json from af where id in ({','.join('?' * len(tracks))})"
+    rows = af_cache.execute(query, tracks).fetchall()
+    return {track: orjson.loads(af) for track, af in rows}
+
+
+def insert_audio_features(af_cache, tracks_af: dict):
+    rows = [(track, orjson.dumps(af).decode()) for track, af in tracks_af.items() if af]
+    with af_cache:
+        af_cache.executemany("insert or replace into af values (?, ?)", rows)